@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import random
 import sys
+import time
 
 
 """ constants """
@@ -9,21 +11,21 @@ ROUNDS = 8  # num of rounds
 BLOCK_SIZE = 8  # block size in bytes
 BLOCK_SIZE_BITS = BLOCK_SIZE * 8  # block size in bits
 SECRET = 0xD73A01986CB1DDF7  # base key (64-bit)
+HALF_BITS = BLOCK_SIZE_BITS // 2  # word size of a half-block
 F32 = 0xFFFFFFFF
 
 
 """ util functions """
 
 
-# bitwise circular right shift
-def ror(x, n, xsize):
-    return (x >> n) + (x << (xsize - n))
+# bitwise circular right shift of an xsize-bit word
+def ror(x, n, xsize=HALF_BITS):
+    return (x >> n | x << (xsize - n)) & ((1 << xsize) - 1)
 
 
-# bitwise circular left shift
-def rol(x, n, xsize):
-    remains = x >> (xsize - n)
-    return (x << n) - (remains << xsize) + remains
+# bitwise circular left shift of an xsize-bit word
+def rol(x, n, xsize=HALF_BITS):
+    return (x << n | x >> (xsize - n)) & ((1 << xsize) - 1)
 
 
 # round key generation
@@ -33,8 +35,8 @@ def gen_rkey(r):
 
 # gen func
 def f(subBlock, key):
-    f1 = rol(subBlock, 9, sys.getsizeof(subBlock))
-    f2 = ror(key, 11, sys.getsizeof(key)) + subBlock
+    f1 = rol(subBlock, 9)
+    f2 = (ror(key, 11) + subBlock) & F32
     return f1 ^ (not f2)
 
 
@@ -58,6 +60,11 @@ def create_rkeys(debug=False):
     return round_keys
 
 
+# per-key round table: round keys already rotated the way f() needs them
+def create_rtable(round_keys):
+    return [ror(rkey, 11) for rkey in round_keys]
+
+
 # encrypt one block
 def cipher(block, round_keys, debug=False):
     L, R = split(block)
@@ -79,6 +86,60 @@ def cipher(block, round_keys, debug=False):
     return join(L, R)
 
 
+# encrypt one block with f() inlined over a round table
+def cipher_table(block, round_table):
+    L, R = block >> HALF_BITS, block & F32
+
+    for rkey in round_table[:-1]:
+        Ln = (L << 9 | L >> (HALF_BITS - 9)) & F32 ^ (not (rkey + L) & F32)
+        L, R = R ^ Ln, L
+
+    rkey = round_table[-1]
+    Ln = (L << 9 | L >> (HALF_BITS - 9)) & F32 ^ (not (rkey + L) & F32)
+    return L << HALF_BITS | R ^ Ln
+
+
+# the round function as first written, rotating within sys.getsizeof()
+# bits and unmasked; kept only to time cipher() against it in benchmark()
+def f_original(subBlock, key):
+    xsize = sys.getsizeof(subBlock)
+    remains = subBlock >> (xsize - 9)
+    f1 = (subBlock << 9) - (remains << xsize) + remains
+    xsize = sys.getsizeof(key)
+    f2 = (key >> 11) + (key << (xsize - 11)) + subBlock
+    return f1 ^ (not f2)
+
+
+# cipher() over f_original()
+def cipher_original(block, round_keys):
+    L, R = split(block)
+
+    for r, rkey in enumerate(round_keys):
+        Ln = f_original(L, rkey)
+        if r < ROUNDS - 1:
+            L, R = R ^ Ln, L
+        else:
+            L, R = L, R ^ Ln
+
+    return join(L, R)
+
+
+# ns per block for the original cipher, cipher() and cipher_table()
+def benchmark(count=100000):
+    round_keys = create_rkeys()
+    round_table = create_rtable(round_keys)
+    blocks = [random.getrandbits(BLOCK_SIZE_BITS) for _ in range(count)]
+
+    for name, func, keys in (("original", cipher_original, round_keys),
+                             ("cipher", cipher, round_keys),
+                             ("cipher_table", cipher_table, round_table)):
+        start = time.perf_counter_ns()
+        for block in blocks:
+            func(block, keys)
+        elapsed = time.perf_counter_ns() - start
+        print("{}: {:.0f} ns/block".format(name, elapsed / count))
+
+
 def main():
     print("key {}".format(hex(SECRET)))
     round_keys = create_rkeys(debug=False)
@@ -92,6 +153,16 @@ def main():
     decrypted_msg = cipher(encrypted_msg, round_keys[::-1], debug=False)
     print("decrypted message {}".format(hex(decrypted_msg)))
 
+    round_table = create_rtable(round_keys)
+    assert cipher_table(msg, round_table) == encrypted_msg
+    assert cipher_table(encrypted_msg, round_table[::-1]) == msg
+
+    # a block whose last round has (rkey + L) & F32 == 0
+    edge = cipher(join(-round_table[-1] & F32, 0x12345678), round_keys[::-1])
+    assert cipher_table(edge, round_table) == cipher(edge, round_keys)
+
+#    benchmark()
+
 
 if __name__ == "__main__":
     main()
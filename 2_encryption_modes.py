@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
+import argparse
+import mmap
+import os
 import secrets
-from functools import reduce
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache, reduce
+from multiprocessing import Pool
+
+import numpy as np
 
 
 """ constants """
@@ -10,6 +20,8 @@ ROUNDS = 8  # num of rounds
 BLOCK_SIZE = 8  # block size in bytes
 BLOCK_SIZE_BITS = BLOCK_SIZE * 8  # block size in bits
 SECRET = 0xD73A01986CB1DDF7  # base key (64-bit)
+KEY_CACHE_SIZE = 256  # num of round key schedules kept by key_schedule()
+FILE_CHUNK = 1 << 20  # bytes processed at once by encrypt/decrypt_file
 
 encoding = 'utf-8'
 
@@ -19,13 +31,13 @@ encoding = 'utf-8'
 
 # bitwise circular right shift
 def ror(x, n, xsize):
-    shift = n % xsize
+    shift = n % xsize if xsize else 0
     return tail(x, shift) << (xsize - shift) | (x >> shift)
 
 
 # bitwise circular left shift
 def rol(x, n, xsize):
-    shift = n % xsize
+    shift = n % xsize if xsize else 0
     return tail(x, xsize - shift) << shift | head(x, shift, xsize)
 
 
@@ -64,7 +76,8 @@ def split(block, n):
 
 # split block into half-block_size chunks
 def halves(block, block_size):
-    return tuple(split(block, ceil(block_size, 2) // 2))
+    half = ceil(block_size, 2) // 2
+    return block >> half, tail(block, half)
 
 
 # get the closest integer larger than n divisible by div
@@ -80,28 +93,62 @@ def join(subblocks):
 
 # convert string to hex
 def string_to_hex(s, debug=False):
-    hex_chars = [ch.encode(encoding).hex() for ch in s]
-    hexa = '0x' + reduce(lambda x, y: x + y, hex_chars)
+    hexa = int.from_bytes(s.encode(encoding), 'big')
     if debug:
-        print(hexa)
-    return int(hexa, 16)
+        print(hex(hexa))
+    return hexa
 
 
 # convert hex to string
 def hex_to_string(hexa, debug=False):
-    s = bytes.fromhex(hex(hexa)[2:]).decode(encoding)
+    s = hexa.to_bytes(ceil(hexa.bit_length(), 8) // 8, 'big').decode(encoding)
     if debug:
         print(s)
     return s
 
 
+""" codec """
+
+
+# view bytes (bytearray, memoryview, ...) as an array of 64-bit blocks
+# without copying; the incomplete last block is returned separately
+def to_blocks(data):
+    data = memoryview(data).cast('B')
+    full = len(data) - len(data) % BLOCK_SIZE
+    return np.frombuffer(data[:full], dtype='>u8'), data[full:]
+
+
+# convert blocks (uint64 array or list of ints) back to bytes
+def from_blocks(blocks):
+    return np.asarray(blocks, dtype=np.uint64).astype('>u8').tobytes()
+
+
+# xor data with the first len(data) bytes of stream
+def xor_bytes(data, stream):
+    data = np.frombuffer(data, dtype=np.uint8)
+    return (data ^ np.frombuffer(stream, np.uint8, len(data))).tobytes()
+
+
+# PKCS#7 padding up to a whole number of blocks
+def pad(data):
+    padding = BLOCK_SIZE - len(data) % BLOCK_SIZE
+    return bytes(data) + bytes([padding]) * padding
+
+
+def unpad(data):
+    padding = data[-1] if len(data) else 0
+    if not 0 < padding <= BLOCK_SIZE or \
+            data[-padding:] != bytes([padding]) * padding:
+        raise ValueError('Bad padding')
+    return data[:-padding]
+
+
 """ crypto functions """
 
 
 # generate key for r-th round
 def gen_rkey(r, secret, block_size=64):
-    return (ror(secret, r * 3, block_size)) &\
-            int("1" * ceil(block_size // 2, 2), 2)
+    return tail(ror(secret, r * 3, block_size), ceil(block_size // 2, 2))
 
 
 # generate round keys
@@ -113,6 +160,24 @@ def create_rkeys(secret, rounds=8, block_size=64, debug=False):
     return round_keys
 
 
+# forward and reverse round keys, cached per (secret, rounds, block_size);
+# key_schedule.cache_info() reports hits and misses
+def key_schedule(secret, rounds=8, block_size=64):
+    return _key_schedule(secret, rounds, block_size)
+
+
+# called positionally only, so one key is one cache entry however
+# key_schedule() was called
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _key_schedule(secret, rounds, block_size):
+    round_keys = tuple(create_rkeys(secret, rounds, block_size))
+    return round_keys, round_keys[::-1]
+
+
+key_schedule.cache_info = _key_schedule.cache_info
+key_schedule.cache_clear = _key_schedule.cache_clear
+
+
 # encrypt one block
 def feistel(block, round_keys, block_size=64, debug=False):
     assert block.bit_length() <= block_size
@@ -135,7 +200,48 @@ def feistel(block, round_keys, block_size=64, debug=False):
         if debug:
             print("L = {} R = {}".format(hex(L), hex(R)))
 
-    return join([L, R])
+    return L << (ceil(block_size, 2) // 2) | R
+
+
+# bit length of every element of a uint64 array holding values < 2**53
+def bit_lengths(x):
+    return np.frexp(x.astype(np.float64))[1].astype(np.uint64)
+
+
+# rol() over arrays, rotating each element within its own bit length
+def rol_batch(x, n):
+    xsize = bit_lengths(x)
+    shift = np.uint64(n) % np.maximum(xsize, np.uint64(1))
+    shift[xsize == 0] = 0
+    rest = xsize - shift
+    return (x & ((np.uint64(1) << rest) - np.uint64(1))) << shift | x >> rest
+
+
+# f() over an array of sub-blocks with a single round key
+def f_batch(subBlocks, key):
+    f1 = rol_batch(subBlocks, 9)
+    # not f2 is set only if both the key and the sub-block are zero
+    if key:
+        return f1
+    return f1 ^ (subBlocks == 0).astype(np.uint64)
+
+
+# encrypt an array of blocks (uint64), same result as feistel() on each
+def feistel_batch(blocks, round_keys, block_size=64):
+    half = np.uint64(ceil(block_size, 2) // 2)
+    mask = (np.uint64(1) << half) - np.uint64(1)
+    blocks = np.asarray(blocks, dtype=np.uint64)
+    L, R = blocks >> half, blocks & mask
+    rounds = len(round_keys)
+
+    for r, rkey in enumerate(round_keys):
+        Ln = f_batch(L, rkey)
+        if r < rounds - 1:
+            L, R = R ^ Ln, L
+        else:
+            R = R ^ Ln
+
+    return L << half | R
 
 
 #def feistel_generalized(message, round_keys, block_size=64, debug=False):
@@ -156,13 +262,16 @@ def feistel(block, round_keys, block_size=64, debug=False):
 #    return join(blocks)
 
 
+# CBC over bytes; the message is padded, so any length round-trips
 def cbc(message, secret, iv, rounds=8, decrypt=False, debug=False):
-    block_size = ceil(iv.bit_length(), 8)
-    round_keys = create_rkeys(secret, rounds, block_size, debug=debug)
-    if decrypt:
-        round_keys = round_keys[::-1]
-
-    blocks = split(message, block_size)
+    forward, reverse = key_schedule(secret, rounds)
+    round_keys = reverse if decrypt else forward
+
+    blocks, rest = to_blocks(message if decrypt else pad(message))
+    if len(rest):
+        raise ValueError('CBC input must be a multiple of {} bytes'
+                         .format(BLOCK_SIZE))
+    blocks = blocks.tolist()
     key = iv
 
     for i in range(len(blocks)):
@@ -172,25 +281,22 @@ def cbc(message, secret, iv, rounds=8, decrypt=False, debug=False):
 
         data = blocks[i]
         if not decrypt:
-            blocks[i] = feistel(data ^ key, round_keys,
-                                block_size, debug)
+            blocks[i] = feistel(data ^ key, round_keys, debug=debug)
         else:
-            blocks[i] = feistel(data, round_keys,
-                                block_size, debug) ^ key
+            blocks[i] = feistel(data, round_keys, debug=debug) ^ key
         key = data if decrypt else blocks[i]
 
     if debug:
         print("block to join: {}".format([hex(b) for b in blocks]))
-    return join(blocks)
+    return unpad(from_blocks(blocks)) if decrypt else from_blocks(blocks)
 
 
+# CFB over bytes; the incomplete last block uses part of the keystream
 def cfb(message, secret, iv, rounds=8, decrypt=False, debug=False):
-    block_size = ceil(iv.bit_length(), 8)
-    round_keys = create_rkeys(secret, rounds, block_size, debug=debug)
-    if decrypt:
-        round_keys = round_keys[::-1]
+    round_keys = key_schedule(secret, rounds)[0]
 
-    blocks = split(message, block_size)
+    blocks, rest = to_blocks(message)
+    blocks = blocks.tolist()
     key = iv
 
     for i in range(len(blocks)):
@@ -199,13 +305,477 @@ def cfb(message, secret, iv, rounds=8, decrypt=False, debug=False):
             print("key[{}] = {}".format(i, hex(key)))
 
         data = blocks[i]
-        blocks[i] = feistel(key, round_keys,
-                            block_size, debug) ^ data
+        blocks[i] = feistel(key, round_keys, debug=debug) ^ data
         key = data if decrypt else blocks[i]
 
     if debug:
         print("block to join: {}".format([hex(b) for b in blocks]))
-    return join(blocks)
+    stream = from_blocks([feistel(key, round_keys)]) if len(rest) else b''
+    return from_blocks(blocks) + xor_bytes(rest, stream)
+
+
+# xor a piece of the message with the keystream from block `start` on;
+# counters are iv + block index (mod 2**64)
+def ctr_chunk(chunk, round_keys, iv, start):
+    count = ceil(len(chunk), BLOCK_SIZE) // BLOCK_SIZE
+    counters = np.arange(start, start + count, dtype=np.uint64) + np.uint64(iv)
+    return xor_bytes(chunk, from_blocks(feistel_batch(counters, round_keys)))
+
+
+def ctr_task(args):
+    return ctr_chunk(*args)
+
+
+# encrypt (decrypt) bytes in CTR mode; counter ranges of chunk_size
+# bytes are handed to a pool of `workers` processes
+def ctr(message, secret, iv, rounds=8, workers=1, chunk_size=1 << 20):
+    round_keys = key_schedule(secret, rounds)[0]
+    iv = tail(iv, BLOCK_SIZE_BITS)
+    data = memoryview(message).cast('B')
+    if chunk_size < BLOCK_SIZE:
+        raise ValueError('chunk_size must be at least {} bytes'
+                         .format(BLOCK_SIZE))
+    chunk_size = ceil(chunk_size, BLOCK_SIZE)
+    tasks = ((bytes(data[i:i+chunk_size]), round_keys, iv, i // BLOCK_SIZE)
+             for i in range(0, len(data), chunk_size))
+
+    if workers == 1:
+        return b''.join(map(ctr_task, tasks))
+    with Pool(workers) as pool:
+        return b''.join(pool.imap(ctr_task, tasks))
+
+
+# decrypt whole 64-bit CBC/CFB blocks at once: every plaintext block
+# depends only on its own ciphertext block and the previous one (key)
+def decrypt_chunk(mode, chunk, round_keys, key):
+    blocks = to_blocks(chunk)[0].astype(np.uint64)
+    prev = np.empty_like(blocks)
+    prev[0] = key
+    prev[1:] = blocks[:-1]
+    if mode == 'cbc':
+        out = feistel_batch(blocks, round_keys) ^ prev
+    else:
+        out = feistel_batch(prev, round_keys) ^ blocks
+    return from_blocks(out)
+
+
+def decrypt_task(args):
+    return decrypt_chunk(*args)
+
+
+# decrypt CBC/CFB bytes on a pool of `workers` processes; every slice of
+# chunk_size bytes is sent along with the ciphertext block preceding it
+def decrypt_parallel(mode, message, secret, iv, rounds=8, workers=1,
+                     chunk_size=1 << 20):
+    s = Stream(mode, secret, iv, rounds, decrypt=True, padding=False)
+    data = memoryview(message).cast('B')
+    full = len(data) - len(data) % BLOCK_SIZE
+    if chunk_size < BLOCK_SIZE:
+        raise ValueError('chunk_size must be at least {} bytes'
+                         .format(BLOCK_SIZE))
+    chunk_size = ceil(chunk_size, BLOCK_SIZE)
+    tasks = ((mode, bytes(data[i:min(i+chunk_size, full)]), s.round_keys,
+              int.from_bytes(data[i-BLOCK_SIZE:i], 'big') if i else iv)
+             for i in range(0, full, chunk_size))
+
+    if workers == 1:
+        out = b''.join(map(decrypt_task, tasks))
+    else:
+        with Pool(workers) as pool:
+            out = b''.join(pool.imap(decrypt_task, tasks))
+
+    if full:
+        s.key = int.from_bytes(data[full-BLOCK_SIZE:full], 'big')
+    out += s.update(data[full:]) + s.finalize()
+    return unpad(out) if mode == 'cbc' else out
+
+
+""" streaming """
+
+
+# CBC/CFB encryptor (or decryptor) working on bytes chunks;
+# keeps the chaining value and an incomplete block between updates;
+# with padding, CBC pads (unpads) at finalize() like cbc() does, holding
+# back the last decrypted block until then
+class Stream:
+    def __init__(self, mode, secret, iv, rounds=8, decrypt=False,
+                 padding=True):
+        if mode not in ('cbc', 'cfb'):
+            raise ValueError('Unknown mode: {}'.format(mode))
+        self.mode = mode
+        self.decrypt = decrypt
+        self.padding = padding and mode == 'cbc'
+        self.held = b''
+        # CFB runs the block cipher forward in both directions
+        forward, reverse = key_schedule(secret, rounds)
+        self.round_keys = reverse if decrypt and mode == 'cbc' else forward
+        self.key = iv
+        self.pending = bytearray()
+
+    # process one full block given as int
+    def block(self, data):
+        if self.mode == 'cbc':
+            if not self.decrypt:
+                self.key = feistel(data ^ self.key, self.round_keys)
+                return self.key
+            out = feistel(data, self.round_keys) ^ self.key
+        else:
+            out = feistel(self.key, self.round_keys) ^ data
+        self.key = data if self.decrypt else out
+        return out
+
+    # process whole blocks; decryption handles them all at once
+    def blocks(self, blocks):
+        if not self.decrypt:
+            return from_blocks([self.block(b) for b in blocks.tolist()])
+        if not len(blocks):
+            return b''
+        out = decrypt_chunk(self.mode, blocks, self.round_keys, self.key)
+        self.key = int(blocks[-1])
+        return out
+
+    # feed a chunk, return output for every block completed by it
+    def update(self, chunk):
+        data = memoryview(chunk).cast('B')
+        out = b''
+
+        if self.pending:
+            need = BLOCK_SIZE - len(self.pending)
+            self.pending += data[:need]
+            data = data[need:]
+            if len(self.pending) < BLOCK_SIZE:
+                return out
+            out = self.blocks(to_blocks(self.pending)[0])
+            self.pending = bytearray()
+
+        blocks, rest = to_blocks(data)
+        out += self.blocks(blocks)
+        self.pending += rest
+        if self.padding and self.decrypt:
+            out = self.held + out
+            self.held = out[-BLOCK_SIZE:]
+            out = out[:-BLOCK_SIZE]
+        return out
+
+    # flush the incomplete last block: CFB encrypts what is left, CBC
+    # pads it (or unpads the held back block) if padding is on
+    def finalize(self):
+        if self.padding and not self.decrypt:
+            padding = BLOCK_SIZE - len(self.pending)
+            return self.update(bytes([padding]) * padding)
+        if self.mode == 'cbc' and self.pending:
+            raise ValueError('CBC input must be a multiple of {} bytes'
+                             .format(BLOCK_SIZE))
+        if self.padding:
+            out, self.held = unpad(self.held), b''
+            return out
+        if not self.pending:
+            return b''
+        stream = from_blocks([feistel(self.key, self.round_keys)])
+        out = xor_bytes(self.pending, stream)
+        self.pending = bytearray()
+        return out
+
+
+# encrypt (decrypt) an iterable of bytes chunks, yielding output chunks
+def stream(chunks, mode, secret, iv, rounds=8, decrypt=False, padding=True):
+    s = Stream(mode, secret, iv, rounds, decrypt, padding)
+    for chunk in chunks:
+        out = s.update(chunk)
+        if out:
+            yield out
+    out = s.finalize()
+    if out:
+        yield out
+
+
+""" cipher context """
+
+
+# all modes under one key; round keys come from the key_schedule() cache
+class Cipher:
+    def __init__(self, secret, rounds=8):
+        self.secret = secret
+        self.rounds = rounds
+        self.forward, self.reverse = key_schedule(secret, rounds)
+
+    def encrypt_block(self, block):
+        return feistel(block, self.forward)
+
+    def decrypt_block(self, block):
+        return feistel(block, self.reverse)
+
+    def cbc_encrypt(self, message, iv):
+        return cbc(message, self.secret, iv, self.rounds)
+
+    def cbc_decrypt(self, message, iv, workers=1):
+        return decrypt_parallel('cbc', message, self.secret, iv,
+                                self.rounds, workers)
+
+    def cfb_encrypt(self, message, iv):
+        return cfb(message, self.secret, iv, self.rounds)
+
+    def cfb_decrypt(self, message, iv, workers=1):
+        return decrypt_parallel('cfb', message, self.secret, iv,
+                                self.rounds, workers)
+
+    def ctr_encrypt(self, message, iv, workers=1):
+        return ctr(message, self.secret, iv, self.rounds, workers)
+
+    ctr_decrypt = ctr_encrypt
+
+    @staticmethod
+    def cache_info():
+        return key_schedule.cache_info()
+
+
+""" files """
+
+
+# let the kernel drop already processed pages of a map
+def release(mm, done, pos):
+    end = pos - pos % mmap.PAGESIZE
+    if end > done and hasattr(mmap, 'MADV_DONTNEED'):
+        mm.madvise(mmap.MADV_DONTNEED, done, end - done)
+    return max(done, end)
+
+
+# feed data from offset skip on to a stream chunk by chunk, writing
+# the output to out from offset pos on; prints progress and throughput
+def pipe(s, data, skip, out, pos, chunk_size=FILE_CHUNK):
+    total = len(data) - skip
+    start = time.perf_counter()
+    data_done = out_done = 0
+
+    for i in range(skip, len(data), chunk_size):
+        res = s.update(data[i:i+chunk_size])
+        out[pos:pos+len(res)] = res
+        pos += len(res)
+        data_done = release(data, data_done, i + chunk_size)
+        out_done = release(out, out_done, pos)
+
+        done = min(i + chunk_size, len(data)) - skip
+        elapsed = time.perf_counter() - start
+        print("\r{:5.1f}% {:.2f} MB/s".format(
+            100 * done / total, done / max(elapsed, 1e-9) / 1e6),
+            end='', flush=True)
+
+    if total:
+        print()
+    return pos
+
+
+# map a whole file (mmap cannot map an empty one)
+def map_file(file, size, access=mmap.ACCESS_WRITE):
+    if not size:
+        return bytearray()
+    return mmap.mmap(file.fileno(), size, access=access)
+
+
+# temporary file next to dst, opened for writing; it replaces dst when
+# the block exits normally and is removed otherwise, so a failure (or
+# src being dst) never leaves dst truncated or half written
+@contextmanager
+def output_file(dst):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)))
+    try:
+        with os.fdopen(fd, 'w+b') as file:
+            yield file
+        os.replace(tmp, dst)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+# encrypt src into dst: iv block followed by the CBC/CFB ciphertext;
+# CBC input is padded PKCS#7-style, so decryption restores the length
+def encrypt_file(src, dst, mode, secret, iv=None, rounds=8,
+                 chunk_size=FILE_CHUNK):
+    if iv is None:
+        iv = int(secrets.token_hex(BLOCK_SIZE), 16)
+    s = Stream(mode, secret, iv, rounds)
+
+    with open(src, 'rb') as fin, output_file(dst) as fout:
+        size = os.fstat(fin.fileno()).st_size
+        padding = BLOCK_SIZE - size % BLOCK_SIZE if mode == 'cbc' else 0
+        out_size = BLOCK_SIZE + size + padding
+        fout.truncate(out_size)
+
+        data = map_file(fin, size, mmap.ACCESS_READ)
+        out = map_file(fout, out_size)
+        try:
+            out[:BLOCK_SIZE] = iv.to_bytes(BLOCK_SIZE, 'big')
+            pos = pipe(s, data, 0, out, BLOCK_SIZE, chunk_size)
+            res = s.finalize()
+            out[pos:pos+len(res)] = res
+        finally:
+            out.close()
+            if size:
+                data.close()
+
+
+# decrypt a file written by encrypt_file(); dst is replaced only once
+# decryption and the padding check succeed
+def decrypt_file(src, dst, mode, secret, rounds=8, chunk_size=FILE_CHUNK):
+    size = os.path.getsize(src) - BLOCK_SIZE
+    if size < 0 or mode == 'cbc' and (not size or size % BLOCK_SIZE):
+        raise ValueError('{} is not a {} encrypted file'
+                         .format(src, mode.upper()))
+
+    with open(src, 'rb') as fin, output_file(dst) as fout:
+        fout.truncate(size)
+
+        data = map_file(fin, size + BLOCK_SIZE, mmap.ACCESS_READ)
+        out = map_file(fout, size)
+        try:
+            s = Stream(mode, secret, int.from_bytes(data[:BLOCK_SIZE], 'big'),
+                       rounds, decrypt=True)
+            pos = pipe(s, data, BLOCK_SIZE, out, 0, chunk_size)
+            res = s.finalize()
+            out[pos:pos+len(res)] = res
+            pos += len(res)
+        finally:
+            if size:
+                out.close()
+            data.close()
+        fout.truncate(pos)
+
+
+# command line: encrypt or decrypt a file
+def file_command(argv):
+    parser = argparse.ArgumentParser(
+        description='Encrypt or decrypt a file with the Feistel cipher')
+    parser.add_argument('command', choices=['encrypt', 'decrypt'])
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    parser.add_argument('-k', '--key', required=True,
+                        help='64-bit key in hex')
+    parser.add_argument('-m', '--mode', choices=['cbc', 'cfb'],
+                        default='cbc')
+    parser.add_argument('-c', '--chunk', type=int, default=FILE_CHUNK,
+                        help='chunk size in bytes')
+    args = parser.parse_args(argv)
+
+    secret = int(args.key, 16)
+    if args.command == 'encrypt':
+        encrypt_file(args.src, args.dst, args.mode, secret,
+                     chunk_size=args.chunk)
+    else:
+        decrypt_file(args.src, args.dst, args.mode, secret,
+                     chunk_size=args.chunk)
+
+
+# check feistel_batch() against feistel() and compare their speed
+def test_feistel_batch(secret, count=100000):
+    round_keys = create_rkeys(secret)
+    blocks = np.frombuffer(secrets.token_bytes(count * BLOCK_SIZE),
+                           dtype=np.uint64).copy()
+    blocks[:4] = [0, 1, 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF]
+
+    start = time.perf_counter()
+    expected = [feistel(int(b), round_keys) for b in blocks]
+    scalar = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = feistel_batch(blocks, round_keys)
+    batch = time.perf_counter() - start
+
+    assert [int(b) for b in result] == expected
+    print("feistel: {:.0f} blocks/s".format(count / scalar))
+    print("feistel_batch: {:.0f} blocks/s".format(count / batch))
+
+
+# check ctr() against feistel() and compare worker counts
+def test_ctr(secret, size=1 << 24, workers=4):
+    iv = int(secrets.token_hex(BLOCK_SIZE), 16)
+    data = secrets.token_bytes(size)
+    round_keys = create_rkeys(secret)
+
+    head = data[:1000]
+    stream = b''.join(feistel((iv + i) % (1 << BLOCK_SIZE_BITS), round_keys)
+                      .to_bytes(BLOCK_SIZE, 'big') for i in range(125))
+    assert ctr(head, secret, iv) == bytes(a ^ b for a, b in zip(head, stream))
+
+    results = []
+    for w in (1, workers):
+        start = time.perf_counter()
+        results.append(ctr(data, secret, iv, workers=w))
+        elapsed = time.perf_counter() - start
+        print("ctr, {} worker(s): {:.1f} MB/s".format(w, size / elapsed / 1e6))
+    assert results[0] == results[1]
+    assert ctr(results[0], secret, iv, workers=workers) == data
+
+
+# check decrypt_parallel() against the serial stream decryption
+def test_decrypt_parallel(secret, size=1 << 18, workers=4):
+    iv = int(secrets.token_hex(BLOCK_SIZE), 16)
+    data = secrets.token_bytes(size)
+
+    for mode in ('cbc', 'cfb'):
+        enc = b''.join(stream([data], mode, secret, iv))
+        serial = b''.join(stream([enc], mode, secret, iv, decrypt=True))
+        for w in (1, workers):
+            start = time.perf_counter()
+            dec = decrypt_parallel(mode, enc, secret, iv, workers=w,
+                                   chunk_size=size // 16)
+            elapsed = time.perf_counter() - start
+            assert dec == serial == data
+            print("{} decrypt, {} worker(s): {:.1f} MB/s"
+                  .format(mode, w, size / elapsed / 1e6))
+
+
+# round trip through encrypt_file() and decrypt_file()
+def test_file(secret, size=1 << 20):
+    src, enc, dec = ('feistel_test.' + ext for ext in ('in', 'enc', 'out'))
+    files = sorted(set(os.listdir()) | {src, enc, dec})
+    try:
+        for mode in ('cbc', 'cfb'):
+            for n in (0, 1, BLOCK_SIZE, size + 3):
+                data = secrets.token_bytes(n)
+                with open(src, 'wb') as file:
+                    file.write(data)
+                encrypt_file(src, enc, mode, secret)
+                decrypt_file(enc, dec, mode, secret)
+                with open(dec, 'rb') as file:
+                    assert file.read() == data
+
+                # in place
+                encrypt_file(src, src, mode, secret)
+                decrypt_file(src, src, mode, secret)
+                with open(src, 'rb') as file:
+                    assert file.read() == data
+
+        # a failed encryption or decryption leaves dst as it was
+        with open(dec, 'wb') as file:
+            file.write(b'old')
+        try:
+            encrypt_file(src, dec, 'cbc', secret, iv=-1)  # iv fails to_bytes
+            assert False
+        except OverflowError:
+            pass
+        with open(dec, 'rb') as file:
+            assert file.read() == b'old'
+
+        iv = BLOCK_SIZE * b'\x01'
+        s = Stream('cbc', secret, int.from_bytes(iv, 'big'), 8, padding=False)
+        bad_padding = iv + s.update(BLOCK_SIZE * b'\x00') + s.finalize()
+        for content in (iv + b'\x00', bad_padding):
+            with open(enc, 'wb') as file:
+                file.write(content)
+            with open(dec, 'wb') as file:
+                file.write(b'old')
+            try:
+                decrypt_file(enc, dec, 'cbc', secret)
+                assert False
+            except ValueError:
+                pass
+            with open(dec, 'rb') as file:
+                assert file.read() == b'old'
+        assert sorted(os.listdir()) == files
+    finally:
+        for name in (src, enc, dec):
+            if os.path.exists(name):
+                os.remove(name)
 
 
 def lab1(msg_hex, secret):
@@ -224,36 +794,57 @@ def lab1(msg_hex, secret):
           .format(hex_to_string(decrypted_msg, debug=False)))
 
 
-def lab2(msg_hex, secret):
+def lab2(msg, secret):
     iv = int(secrets.token_hex(BLOCK_SIZE), 16)
     print("iv: {}".format(hex(iv)))
     
     print("===== CBC =====")
     print("--- encrypt ---")
-    cbc_msg = cbc(msg_hex, secret, iv, debug=False)
-    print("cbc message hex: {}".format(hex(cbc_msg)))
+    cbc_msg = cbc(msg, secret, iv, debug=False)
+    print("cbc message hex: {}".format(cbc_msg.hex()))
 
     print("--- decrypt ---")
     cbc_decrypted_msg = cbc(cbc_msg, secret, iv,  decrypt=True, debug=False)
-    print("cbc decrypted message hex: {}".format(hex(cbc_decrypted_msg)))
-    assert msg_hex == cbc_decrypted_msg
+    print("cbc decrypted message hex: {}".format(cbc_decrypted_msg.hex()))
+    assert msg == cbc_decrypted_msg
     print("cbc decrypted message: {}"
-          .format(hex_to_string(cbc_decrypted_msg, debug=False)))
+          .format(cbc_decrypted_msg.decode(encoding)))
 
     print("===== CFB =====")
     print("--- encrypt ---")
-    cfb_msg = cfb(msg_hex, secret, iv, debug=False)
-    print("cfb message hex: {}".format(hex(cfb_msg)))
+    cfb_msg = cfb(msg, secret, iv, debug=False)
+    print("cfb message hex: {}".format(cfb_msg.hex()))
 
     print("--- decrypt ---")
     cfb_decrypted_msg = cfb(cfb_msg, secret, iv, decrypt=True, debug=False)
-    print("cfb decrypted message hex: {}".format(hex(cfb_decrypted_msg)))
-    assert msg_hex == cfb_decrypted_msg
+    print("cfb decrypted message hex: {}".format(cfb_decrypted_msg.hex()))
+    assert msg == cfb_decrypted_msg
     print("cfb decrypted message: {}"
-          .format(hex_to_string(cfb_decrypted_msg, debug=False)))
+          .format(cfb_decrypted_msg.decode(encoding)))
+
+
+def lab3(msg, secret, chunk=3):
+    iv = int(secrets.token_hex(BLOCK_SIZE), 16)
+    print("iv: {}".format(hex(iv)))
+
+    for mode, func in (('cbc', cbc), ('cfb', cfb)):
+        print("===== {} stream =====".format(mode.upper()))
+        chunks = [msg[i:i+chunk] for i in range(0, len(msg), chunk)]
+        enc = b''.join(stream(chunks, mode, secret, iv))
+        print("{} stream hex: {}".format(mode, enc.hex()))
+        assert enc == func(msg, secret, iv)
+
+        dec = b''.join(stream([enc], mode, secret, iv, decrypt=True))
+        assert dec == msg == func(enc, secret, iv, decrypt=True)
+        print("{} stream decrypted message: {}"
+              .format(mode, dec.decode(encoding)))
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        file_command(sys.argv[1:])
+        sys.exit()
+
     secret = int(secrets.token_hex(BLOCK_SIZE), 16)
     print("secret: {}".format(hex(secret)))
 
@@ -268,4 +859,9 @@ if __name__ == "__main__":
     print("message hex: {}".format(hex(msg_hex)))
 
 #    lab1(msg_hex, secret)
-    lab2(msg_hex, secret)
+    lab2(msg.encode(encoding), secret)
+#    lab3(msg.encode(encoding), secret)
+#    test_feistel_batch(secret)
+#    test_ctr(secret)
+#    test_decrypt_parallel(secret)
+#    test_file(secret)
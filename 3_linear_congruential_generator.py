@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import math
+import os
+import random
+import time
+from functools import lru_cache
+from multiprocessing import Pool
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -14,11 +21,435 @@ def rand(u, m=5, c=0, p=7):
 
 
 def rand_seq(seed, n, m=5, c=0, p=7):
-    g = rand(seed, m, c, p)
-    return [g.__next__() for i in range(n)]
+    return LCG(seed, m, c, p).block(n).tolist()
+
+
+""" jump-ahead """
+# (A, C) such that k steps take u to (A * u + C) % p, in O(log k)
+def jump(k, m=5, c=0, p=7):
+    A, C = 1, 0
+    bm, bc = m % p, c % p  # 1, 2, 4, ... steps at once
+    while k:
+        if k & 1:
+            A, C = A * bm % p, (C * bm + bc) % p
+        bm, bc = bm * bm % p, (bc * bm + bc) % p
+        k >>= 1
+    return A, C
+
+
+# LCG with the same output as rand(), generated a NumPy block at a time;
+# with include_seed the first value is u itself instead of the next one
+class LCG:
+    def __init__(self, u, m=5, c=0, p=7, include_seed=False):
+        self.u, self.m, self.c, self.p = u, m, c, p
+        self.include_seed = include_seed
+        # products of two values below p must fit into int64
+        self.dtype = np.int64 if p <= 2**31 else object
+
+    # jump n values ahead
+    def skip(self, n):
+        if self.include_seed and n:
+            self.include_seed = False
+            n -= 1
+        A, C = jump(n, self.m, self.c, self.p)
+        self.u = (A * self.u + C) % self.p
+        return self
+
+    # next n states u: the first one by a single step, then the filled
+    # part is doubled with jump(filled) until there are n of them
+    def states(self, n):
+        u = np.empty(n, dtype=self.dtype)
+        if not n:
+            return u
+        u[0] = self.u if self.include_seed else (self.u * self.m + self.c) % self.p
+        self.include_seed = False
+        filled = 1
+        while filled < n:
+            k = min(filled, n - filled)
+            A, C = jump(filled, self.m, self.c, self.p)
+            u[filled:filled+k] = (u[:k] * A + C) % self.p
+            filled += k
+        self.u = int(u[-1])
+        return u
+
+    # next n values as float64 (same as rand()) or as uint32 states
+    def block(self, n, dtype=np.float64):
+        u = self.states(n)
+        if dtype == np.uint32:
+            return u.astype(np.uint32)
+        return u.astype(np.float64) / self.p
+
+    # n values in arrays of at most chunk values
+    def blocks(self, n, chunk=1 << 20, dtype=np.float64):
+        for i in range(0, n, chunk):
+            yield self.block(min(chunk, n - i), dtype)
+
+
+""" period """
+TRIAL_BOUND = 1 << 12  # factorize() divides by numbers below it, then uses rho
+MR_BOUND = 3317044064679887385961981
+MR_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+
+# Miller-Rabin for odd n > 41, deterministic below MR_BOUND, with 20 more
+# random bases above
+def is_prime(n):
+    bases = list(MR_BASES)
+    if n >= MR_BOUND:
+        bases += [random.randrange(2, n - 1) for _ in range(20)]
+    d, s = n - 1, 0
+    while not d & 1:
+        d, s = d >> 1, s + 1
+    
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+# Pollard's rho with Brent's cycle detection and batched gcds (as in
+# 4_rsa.py); returns a nontrivial factor of an odd composite n or None
+def pollard_brent(n, seed=None):
+    rnd = random.Random(seed)
+    y, c, m = rnd.randrange(1, n), rnd.randrange(1, n), 128
+    g = r = q = 1
+    
+    while g == 1:
+        x = y
+        for _ in range(r):
+            y = (y * y + c) % n
+        k = 0
+        while k < r and g == 1:
+            ys = y
+            for _ in range(min(m, r - k)):
+                y = (y * y + c) % n
+                q = q * abs(x - y) % n
+            g = math.gcd(q, n)
+            k += m
+        r <<= 1
+    
+    if g == n:
+        # the batch overshot, step through it one by one
+        g = 1
+        while g == 1:
+            ys = (ys * ys + c) % n
+            g = math.gcd(abs(x - ys), n)
+    return g if g != n else None
+
+
+# prime factorization {prime: power}: trial division below TRIAL_BOUND,
+# then Pollard's rho splits what is left until the parts are prime
+def factorize(n):
+    factors = {}
+    d = 2
+    while d * d <= n and d < TRIAL_BOUND:
+        while n % d == 0:
+            factors[d] = factors.get(d, 0) + 1
+            n //= d
+        d += 1 if d == 2 else 2
+    
+    # parts have no factor below TRIAL_BOUND, so below its square they
+    # are prime
+    parts = [n] if n > 1 else []
+    while parts:
+        n = parts.pop()
+        if n < TRIAL_BOUND ** 2 or is_prime(n):
+            factors[n] = factors.get(n, 0) + 1
+            continue
+        seed = 0
+        d = pollard_brent(n, seed)
+        while d is None:
+            seed += 1
+            d = pollard_brent(n, seed)
+        parts += [d, n // d]
+    return factors
+
+
+# Carmichael function: the exponent of the multiplicative group mod n
+def carmichael(n):
+    L = 1
+    for q, k in factorize(n).items():
+        if q == 2 and k >= 3:
+            lq = 2 ** (k - 2)
+        else:
+            lq = (q - 1) * q ** (k - 1)
+        L = L * lq // math.gcd(L, lq)
+    return L
+
+
+# multiplicative order of m mod n, gcd(m, n) = 1: the smallest divisor
+# L of carmichael(n) with m^L = 1
+@lru_cache(maxsize=None)
+def order(m, n):
+    if n == 1:
+        return 1
+    L = carmichael(n)
+    for q in factorize(L):
+        while L % q == 0 and pow(m, L // q, n) == 1:
+            L //= q
+    return L
+
+
+# Hull-Dobell theorem: the period is p for every seed
+@lru_cache(maxsize=None)
+def full_period(m, c, p):
+    primes = factorize(p)
+    return math.gcd(c, p) == 1 and all((m - 1) % q == 0 for q in primes) \
+        and (p % 4 or (m - 1) % 4 == 0)
+
+
+# Brent's cycle detection: length of the cycle the sequence runs into
+def brent(u0, m, c, p):
+    power = lam = 1
+    tortoise, hare = u0, (u0 * m + c) % p
+    while tortoise != hare:
+        if power == lam:
+            tortoise = hare
+            power *= 2
+            lam = 0
+        hare = (hare * m + c) % p
+        lam += 1
+    return lam
+
+
+# period of rand(u0, m, c, p), as test_period() counts it: for c = 0
+# u_k = m^k * u_1, so it is the order of m modulo p / gcd(u_1, p)
+def period(u0, m, c=0, p=7):
+    m, c = m % p, c % p
+    u1 = (u0 * m + c) % p
+    if c == 0:
+        n = p // math.gcd(u1, p)
+        if math.gcd(m, n) == 1:
+            return order(m, n)
+    elif full_period(m, c, p):
+        return p
+    return brent(u1, m, c, p)
+
+
+""" autocorrelation """
+# test_correlation() for lags 0 ... max_lag of a sequence fed chunk by
+# chunk; lag products are summed with FFTs, only max_lag values are kept
+class Autocorrelation:
+    def __init__(self, max_lag):
+        self.K = max_lag
+        self.n = 0
+        self.total = self.squares = 0.0
+        self.products = np.zeros(max_lag + 1)
+        self.head = np.empty(0)  # first K values
+        self.tail = np.zeros(max_lag)  # last K values, zeros before start
+
+    def update(self, chunk):
+        x = np.asarray(chunk, dtype=np.float64)
+        B = len(x)
+        if not B:
+            return self
+        # products[k] += sum x[t] * y[K + t - k], i.e. every pair of values
+        # k apart whose second value is in this chunk
+        y = np.concatenate((self.tail, x))
+        size = 1 << (len(y) + B).bit_length()
+        corr = np.fft.irfft(np.conj(np.fft.rfft(x, size)) *
+                            np.fft.rfft(y, size), size)
+        self.products += corr[self.K::-1]
+
+        self.n += B
+        self.total += x.sum()
+        self.squares += x @ x
+        if len(self.head) < self.K:
+            self.head = np.concatenate((self.head, x[:self.K - len(self.head)]))
+        self.tail = y[len(y) - self.K:]
+        return self
+
+    # coefficients for all lags so far (lags up to n - 1 only)
+    def result(self):
+        K = min(self.K, self.n - 1)
+        lag = np.arange(K + 1)
+        count = self.n - lag
+        head = np.concatenate(([0.0], np.cumsum(self.head[:K])))
+        tail = np.concatenate(([0.0], np.cumsum(self.tail[::-1][:K])))
+        numerator = self.products[:K+1] / count - \
+            (self.total - tail) / count * (self.total - head) / count
+        denominator = self.squares / self.n - (self.total / self.n) ** 2
+        return numerator / denominator
+
+
+# test_correlation(r, k) for every k = 0 ... max_lag (all lags if None)
+def autocorrelation(r, max_lag=None):
+    max_lag = len(r) - 1 if max_lag is None else max_lag
+    return Autocorrelation(max_lag).update(r).result()
+
+
+""" pi """
+# Monte-Carlo pi from consecutive pairs (x, y) of a sequence fed chunk by
+# chunk: x^2 + y^2 < 1 over whole arrays, squared into reused buffers
+class PiEstimator:
+    def __init__(self):
+        self.points = self.inside = 0
+        self.pending = None  # x of a pair split between chunks
+        self.squares = self.sums = np.empty(0)
+
+    def update(self, chunk):
+        x = np.asarray(chunk, dtype=np.float64)
+        if self.pending is not None and len(x):
+            x = np.concatenate(([self.pending], x))
+            self.pending = None
+        if len(x) % 2:
+            self.pending = x[-1]
+            x = x[:-1]
+        n = len(x) // 2
+        if len(self.squares) < len(x):
+            self.squares, self.sums = np.empty(len(x)), np.empty(n)
+        squares, sums = self.squares[:len(x)], self.sums[:n]
+        np.multiply(x, x, out=squares)
+        np.add(squares[0::2], squares[1::2], out=sums)
+        self.inside += n - int(np.count_nonzero(sums >= 1))
+        self.points += n
+        return self
+
+    def estimate(self):
+        return 4 * self.inside / self.points if self.points else float("nan")
+
+    # binomial standard error of the estimate
+    def error(self):
+        if not self.points:
+            return float("nan")
+        q = self.inside / self.points
+        return 4 * math.sqrt(q * (1 - q) / self.points)
+
+
+""" parallel streams """
+# k-th of the blocks of n values the sequence is cut into
+def block_stream(seed, k, n, m=5, c=0, p=7):
+    return LCG(seed, m, c, p).skip(k * n)
+
+
+# j-th of W leapfrogged streams: values j, j + W, j + 2W, ...
+def leapfrog_stream(seed, j, W, m=5, c=0, p=7):
+    A, C = jump(W, m, c, p)
+    u = LCG(seed, m, c, p).skip(j + 1).u
+    return LCG(u, A, C, p, include_seed=True)
+
+
+# num of points (pairs of values) inside the unit circle among n points
+# starting at point `start` of the sequence
+def count_inside(seed, m, c, p, start, n, chunk=1 << 20):
+    estimator = PiEstimator()
+    for r in LCG(seed, m, c, p).skip(2 * start).blocks(2 * n, 2 * chunk):
+        estimator.update(r)
+    return estimator.inside
+
+
+def count_task(args):
+    return count_inside(*args)
+
+
+""" test battery """
+# statistic and degrees of freedom of Pearson's chi-square test
+def chi_square(counts, probs):
+    counts = np.asarray(counts, dtype=np.float64)
+    expected = counts.sum() * np.asarray(probs)
+    return float(((counts - expected) ** 2 / expected).sum()), len(counts) - 1
+
+
+# running statistics of a sequence in (0, 1) fed chunk by chunk, in memory
+# that does not depend on its length:
+#   uniformity  - counts of values in `bins` equal bins
+#   serial      - counts of non-overlapping pairs in cells x cells squares
+#   runs        - number of runs up and down
+#   gap         - lengths of gaps between values in [0, gap_width),
+#                 the ones of `gaps` or longer counted together
+#   pi          - pairs inside the unit circle
+class Battery:
+    def __init__(self, bins=64, cells=16, gap_width=0.5, gaps=10):
+        self.bins, self.cells = bins, cells
+        self.gap_width, self.gaps = gap_width, gaps
+        self.n = 0
+        self.uniformity = np.zeros(bins, dtype=np.int64)
+        self.serial = np.zeros(cells * cells, dtype=np.int64)
+        self.pending = None  # first value of a pair split between chunks
+        self.pi = PiEstimator()
+        self.last = self.up = None  # last value and direction
+        self.runs = 0
+        self.gap_lengths = np.zeros(gaps + 1, dtype=np.int64)
+        self.last_hit = -1
+
+    def update(self, chunk):
+        x = np.asarray(chunk, dtype=np.float64)
+        if not len(x):
+            return self
+        
+        self.uniformity += np.bincount(
+            np.minimum(x * self.bins, self.bins - 1).astype(np.int64),
+            minlength=self.bins)
+        
+        if self.pending is not None:
+            x2 = np.concatenate(([self.pending], x))
+        else:
+            x2 = x
+        self.pending = x2[-1] if len(x2) % 2 else None
+        a, b = x2[0:len(x2)-1:2], x2[1::2]
+        cell = np.minimum(a * self.cells, self.cells - 1).astype(np.int64) * self.cells + \
+            np.minimum(b * self.cells, self.cells - 1).astype(np.int64)
+        self.serial += np.bincount(cell, minlength=self.cells * self.cells)
+        self.pi.update(x)
+        
+        y = x if self.last is None else np.concatenate(([self.last], x))
+        up = y[1:] > y[:-1]
+        if len(up):
+            self.runs += int(np.count_nonzero(up[1:] != up[:-1]))
+            self.runs += self.up is None or bool(up[0] != self.up)
+            self.up = bool(up[-1])
+        self.last = x[-1]
+        
+        hits = np.flatnonzero(x < self.gap_width) + self.n
+        if len(hits):
+            lengths = np.diff(hits, prepend=self.last_hit) - 1
+            self.gap_lengths += np.bincount(np.minimum(lengths, self.gaps),
+                                            minlength=self.gaps + 1)
+            self.last_hit = int(hits[-1])
+        
+        self.n += len(x)
+        return self
+
+    # results so far: (chi-square, degrees of freedom) for the uniformity,
+    # serial and gap tests, z-score of the number of runs, pi estimate and
+    # its standard error
+    def report(self):
+        N = self.n
+        runs = float("nan")
+        if N > 2:
+            runs = (self.runs - (2 * N - 1) / 3) / math.sqrt((16 * N - 29) / 90)
+        p = self.gap_width
+        gap_probs = [p * (1 - p) ** k for k in range(self.gaps)] + [(1 - p) ** self.gaps]
+        return {
+            "n": N,
+            "uniformity": chi_square(self.uniformity, np.full(self.bins, 1 / self.bins)),
+            "serial": chi_square(self.serial, np.full(self.cells ** 2, 1 / self.cells ** 2)),
+            "runs": runs,
+            "gap": chi_square(self.gap_lengths, gap_probs),
+            "pi": (self.pi.estimate(), self.pi.error()),
+        }
 
 
 """ tests """
+# check LCG blocks and skip() against rand()
+def test_block(u0, m, c=0, p=7, n=100000):
+    g = rand(u0, m, c, p)
+    r = [g.__next__() for i in range(n)]
+    
+    assert np.concatenate(list(LCG(u0, m, c, p).blocks(n, 4099))).tolist() == r
+    assert LCG(u0, m, c, p).block(n, np.uint32).tolist() == \
+        [round(x * p) for x in r]
+    k = n // 3
+    assert LCG(u0, m, c, p).skip(k).block(1)[0] == r[k]
+
+
 def test_period(u0, m, p):
     g = rand(u0, m=m, p=p)
     
@@ -41,6 +472,92 @@ def test_correlation(r, k=1):
 def test_pi(r):
     c = sum(1 if np.sqrt(r[2*i]**2 + r[2*i+1]**2) < 1 else 0 for i in range(len(r) // 2))
     return 8 * c / len(r)
+
+
+# test_pi over the first n points, each of `workers` processes counting
+# its own block of the sequence; the result does not depend on workers
+def test_pi_parallel(u0, n, m=5, c=0, p=7, workers=None):
+    if n < 1:
+        raise ValueError('n must be at least 1')
+    workers = workers or os.cpu_count()
+    size = -(-n // workers)
+    tasks = [(u0, m, c, p, start, min(size, n - start))
+             for start in range(0, n, size)]
+    if workers == 1:
+        inside = sum(map(count_task, tasks))
+    else:
+        with Pool(workers) as pool:
+            inside = sum(pool.map(count_task, tasks))
+    return 4 * inside / n
+
+
+# check autocorrelation() (in one piece and in chunks) against
+# test_correlation()
+def test_autocorrelation(r, k_list, chunk=1000):
+    ck = [test_correlation(r, k=k) for k in k_list]
+    assert np.allclose(autocorrelation(r)[k_list], ck)
+    
+    acc = Autocorrelation(max(k_list))
+    for i in range(0, len(r), chunk):
+        acc.update(r[i:i+chunk])
+    assert np.allclose(acc.result()[k_list], ck)
+
+
+# pi estimate, its standard error and points per second, counted over
+# n points of the sequence (without generating it)
+def test_pi_estimator(u0, m, c=0, p=7, n=10**7, chunk=1 << 20):
+    head = LCG(u0, m, c, p).block(1001)
+    estimator = PiEstimator()
+    for i in range(0, len(head), 100):
+        estimator.update(head[i:i+100])
+    assert estimator.estimate() == test_pi(head[:1000].tolist())
+    
+    estimator = PiEstimator()
+    elapsed = 0
+    for r in LCG(u0, m, c, p).blocks(2 * n, 2 * chunk):
+        start = time.perf_counter()
+        estimator.update(r)
+        elapsed += time.perf_counter() - start
+    return estimator.estimate(), estimator.error(), n / elapsed
+
+
+# run the battery over n values of the sequence, chunk values at a time;
+# a one-piece run over the first values must give the same report
+def test_battery(u0, m, c=0, p=7, n=10**7, chunk=1 << 20):
+    head = LCG(u0, m, c, p).block(10007)
+    battery = Battery()
+    for i in range(0, len(head), 1000):
+        battery.update(head[i:i+1000])
+    assert battery.report() == Battery().update(head).report()
+    assert battery.report()["pi"][0] == test_pi(head[:10006].tolist())
+    
+    battery = Battery()
+    for r in LCG(u0, m, c, p).blocks(n, chunk):
+        battery.update(r)
+    return battery.report()
+
+
+# check period() against test_period()
+def test_periods(m, p, seeds=10):
+    for u0 in range(1, p, max(1, p // seeds)):
+        assert period(u0, m, p=p) == test_period(u0, m, p)
+
+
+# check that block and leapfrog streams put together give the sequence
+def test_streams(u0, m, c=0, p=7, n=10000, workers=4):
+    r = LCG(u0, m, c, p).block(n)
+    size = n // workers
+    blocks = [block_stream(u0, k, size, m, c, p).block(size)
+              for k in range(workers)]
+    assert np.array_equal(np.concatenate(blocks), r[:size * workers])
+    
+    frogs = [leapfrog_stream(u0, j, workers, m, c, p).block(size)
+             for j in range(workers)]
+    assert np.array_equal(np.stack(frogs, axis=1).ravel(), r[:size * workers])
+    
+    assert test_pi_parallel(u0, n // 2, m, c, p, 1) == \
+        test_pi_parallel(u0, n // 2, m, c, p, workers) == \
+        test_pi(r[:n // 2 * 2].tolist())
     
 
 if __name__ == "__main__":
@@ -51,13 +568,18 @@ if __name__ == "__main__":
     P = [99999, 13652, 5406546, 450641]
     
     for m, p in zip(M, P):
+        test_block(u0, m, p=p)
+        test_streams(u0, m, p=p)
+        print(test_battery(u0, m, p=p))
+        print("pi = {} +- {} ({:.0f} points/s)".format(*test_pi_estimator(u0, m, p=p)))
         u = list(range(1, p, p // points))
         
         # 1.1. Test generated sequence period
-        L = test_period(u0, m, p)
+        test_periods(m, p, seeds=3)
+        L = period(u0, m, p=p)
         print("L = {}".format(L))
         # 1.2. Plot L(u0) dependency
-        plt.plot(u, [test_period(x, m, p) for x in u])
+        plt.plot(u, [period(x, m, p=p) for x in u])
         plt.show()
         
         r = rand_seq(u0, L, m=m, p=p)
@@ -66,7 +588,9 @@ if __name__ == "__main__":
         plt.show()
         
         # 2. Test correlation
-        ck = [test_correlation(r, k=k) for k in k_list]
+        head = r[:10000]
+        test_autocorrelation(head, [k for k in k_list if k < len(head)][:10])
+        ck = autocorrelation(r)[k_list]
         plt.plot(k_list, ck)
         plt.show()
         
@@ -1,54 +1,286 @@
 import math
+import os
 import random
-from itertools import count, islice
+import secrets
+import time
+from collections import OrderedDict
+from itertools import chain, count, islice
+from multiprocessing import Pool
 
 
-# check if a given number is prime
-def is_prime(n):
-    return n > 1 and all(n % i for i in islice(count(2), int(math.sqrt(n) - 1)))
+# all primes below n (sieve of Eratosthenes)
+def sieve(n):
+    flags = bytearray([1]) * n
+    flags[:2] = b'\x00\x00'
+    for i in range(2, math.isqrt(n - 1) + 1):
+        if flags[i]:
+            flags[i*i::i] = bytes(len(range(i*i, n, i)))
+    return [i for i, flag in enumerate(flags) if flag]
+
+
+SMALL_PRIMES = sieve(2000)
+SIEVE_PRIMES = sieve(1 << 16)[1:]  # odd primes sieved out of prime candidates
+SIEVE_WINDOW = 4096  # num of odd candidates sieved at once
+PUBLIC_EXPONENT = 65537  # standard e, encryption takes 17 squarings
+MIN_KEY_BITS = 16  # smaller moduli leave too few primes to draw p != q from
+SYMBOL_CACHE_SIZE = 4096  # num of symbols/ciphertexts kept by a SymbolTable
+
+worker_key = None  # (function, n, exponent) of a pool worker
+# the first 13 primes as bases make Miller-Rabin exact below this bound
+MR_BOUND = 3317044064679887385961981
+MR_BASES = SMALL_PRIMES[:13]
+
+
+# Miller-Rabin test of an odd n > 2 for the given bases
+def miller_rabin(n, bases):
+    d, s = n - 1, 0
+    while not d & 1:
+        d, s = d >> 1, s + 1
+
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+# check if a given number is prime: trial division by small primes, then
+# Miller-Rabin (deterministic below MR_BOUND, `rounds` random bases above)
+def is_prime(n, rounds=40):
+    if n < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    if n < SMALL_PRIMES[-1] ** 2:
+        return True
+    if n < MR_BOUND:
+        return miller_rabin(n, MR_BASES)
+    return miller_rabin(n, (random.randrange(2, n - 1) for _ in range(rounds)))
+
+
+# odd numbers start, start + 2, ... without a factor in SIEVE_PRIMES
+def sieve_candidates(start):
+    flags = bytearray([1]) * SIEVE_WINDOW
+    for p in SIEVE_PRIMES:
+        # start + 2k = 0 (mod p)
+        k = -(start % p) * ((p + 1) // 2) % p
+        flags[k::p] = bytes(len(range(k, SIEVE_WINDOW, p)))
+    return (start + 2 * k for k, flag in enumerate(flags) if flag)
+
+
+# generate a random prime of exactly `bits` bits; the two top bits are set,
+# so the product of two such primes has exactly 2 * bits bits
+def generate_prime(bits, rounds=8):
+    if bits < 2:
+        raise ValueError('A prime needs at least 2 bits')
+    if bits == 2:
+        return 3
+    if bits <= 17:
+        while True:
+            n = secrets.randbits(bits) | 3 << (bits - 2) | 1
+            if is_prime(n):
+                return n
+
+    while True:
+        start = secrets.randbits(bits) | 3 << (bits - 2) | 1
+        for n in sieve_candidates(start):
+            if n.bit_length() > bits:
+                break
+            # a single base first, it rejects nearly all composites
+            if miller_rabin(n, [2]) and is_prime(n, rounds):
+                return n
 
 
 # calculate the modular inverse x of a and m, i.e. ax ≡ 1 (mod m)
 def mod_inverse(a, m):
     if math.gcd(a, m) != 1:
         raise Exception('Modular inverse does not exist')
-#    a = a % m
-#    for x in range(1, m): 
-#        if ((a * x) % m == 1): 
-#            return x 
-#    return 1
-    temp = m + 1
-    while temp % a:
-        temp += m
-    return temp // a
-
-
-# generate public and private keys for RSA encryption
-def generate_keys(p, q):
-    if not (is_prime(p) and is_prime(q)):
+    return pow(a, -1, m)  # extended Euclidean algorithm
+
+
+# generate a prime p usable with public exponent e, i.e. gcd(e, p-1) = 1
+def generate_factor(bits, e=None):
+    while True:
+        p = generate_prime(bits)
+        if e is None or math.gcd(e, p - 1) == 1:
+            return p
+
+
+# RSA private key kept with its factors for CRT decryption
+class PrivateKey:
+    def __init__(self, p, q, e, d):
+        self.p, self.q = p, q
+        self.n = p * q
+        self.e, self.d = e, d
+        self.dp = d % (p - 1)
+        self.dq = d % (q - 1)
+        self.qinv = mod_inverse(q, p)
+
+    # x^d mod n from two half-size exponentiations (Garner's recombination)
+    def power(self, x):
+        mp = pow(x, self.dp, self.p)
+        mq = pow(x, self.dq, self.q)
+        return mq + self.qinv * (mp - mq) % self.p * self.q
+
+
+# symbol <-> ciphertext table of one key, each direction holding at most
+# `size` entries (least recently used dropped first); every modexp fills
+# both directions, so ciphertexts of symbols encrypted here decrypt with
+# a lookup, without d
+class SymbolTable:
+    def __init__(self, n, e, d=None, size=SYMBOL_CACHE_SIZE):
+        self.n, self.e, self.d = n, e, d
+        self.size = size
+        self.ciphertexts = OrderedDict()  # symbol -> ciphertext
+        self.symbols = OrderedDict()  # ciphertext -> symbol
+
+    def add(self, symbol, ciphertext):
+        for table, key, value in ((self.ciphertexts, symbol, ciphertext),
+                                  (self.symbols, ciphertext, symbol)):
+            table[key] = value
+            table.move_to_end(key)
+            if len(table) > self.size:
+                table.popitem(last=False)
+
+    def encrypt(self, symbol):
+        if symbol in self.ciphertexts:
+            self.ciphertexts.move_to_end(symbol)
+            return self.ciphertexts[symbol]
+        ciphertext = pow(symbol, self.e, self.n)
+        self.add(symbol, ciphertext)
+        return ciphertext
+
+    def decrypt(self, ciphertext):
+        if ciphertext in self.symbols:
+            self.symbols.move_to_end(ciphertext)
+            return self.symbols[ciphertext]
+        if self.d is None:
+            raise ValueError('Unknown ciphertext and no private key')
+        symbol = pow(ciphertext, self.d, self.n)
+        self.add(symbol, ciphertext)
+        return symbol
+
+
+# generate an RSA key as a PrivateKey; arguments as for generate_keys()
+def generate_private_key(p=None, q=None, bits=1024, e=None):
+    if p is None or q is None:
+        if bits < MIN_KEY_BITS:
+            raise ValueError('A key needs at least {} bits'
+                             .format(MIN_KEY_BITS))
+        p = q = generate_factor(bits // 2, e)
+        while q == p:
+            q = generate_factor(bits - bits // 2, e)
+    elif not (is_prime(p) and is_prime(q)):
         raise ValueError('Both numbers must be prime.')
     elif p == q:
         raise ValueError('p and q cannot be equal')
         
-    n = p * q  # 1st part of the public key
-    
     phi = (p-1) * (q-1)
-    e = random.randrange(1, phi)   # 2nd part of the public key
-    while math.gcd(phi, e) != 1:
-        e = random.randrange(1, phi)
+    if e is None:
+        e = random.randrange(1, phi)   # 2nd part of the public key
+        while math.gcd(phi, e) != 1:
+            e = random.randrange(1, phi)
+    elif math.gcd(phi, e) != 1:
+        raise ValueError('e must be coprime with (p-1) * (q-1)')
         
     d = mod_inverse(e, phi)  # private key
     
-    return n, e, d
+    return PrivateKey(p, q, e, d)
+
+
+# generate public and private keys for RSA encryption;
+# without p and q, two primes for a `bits`-bit modulus are generated;
+# e is random unless given (e.g. PUBLIC_EXPONENT)
+def generate_keys(p=None, q=None, bits=1024, e=None):
+    key = generate_private_key(p, q, bits, e)
+    return key.n, key.e, key.d
+
+
+# Pollard's rho with Brent's cycle detection and batched gcds;
+# returns a nontrivial factor of an odd composite n or None
+def pollard_brent(n, seed=None):
+    rnd = random.Random(seed)
+    y, c, m = rnd.randrange(1, n), rnd.randrange(1, n), 128
+    g = r = q = 1
+
+    while g == 1:
+        x = y
+        for _ in range(r):
+            y = (y * y + c) % n
+        k = 0
+        while k < r and g == 1:
+            ys = y
+            for _ in range(min(m, r - k)):
+                y = (y * y + c) % n
+                q = q * abs(x - y) % n
+            g = math.gcd(q, n)
+            k += m
+        r <<= 1
+
+    if g == n:
+        # the batch overshot, step through it one by one
+        g = 1
+        while g == 1:
+            ys = (ys * ys + c) % n
+            g = math.gcd(abs(x - ys), n)
+    return g if g != n else None
+
+
+# Pollard's p-1 with smoothness bound `bound`, random base from seed;
+# returns a nontrivial factor of n or None
+def pollard_pm1(n, seed=None, bound=100000):
+    a = random.Random(seed).randrange(2, n - 1)
+    for p in sieve(bound + 1):
+        a = pow(a, p ** int(math.log(bound, p)), n)
+    g = math.gcd(a - 1, n)
+    return g if 1 < g < n else None
 
 
-def break_key(n):
+def factor_task(args):
+    method, n, seed = args
+    return method(n, seed)
+
+
+# find a nontrivial factor of a composite n: p-1 and random rho starts
+# race on `workers` processes (all cores if None); once one finds a
+# factor the pool is terminated
+def find_factor(n, workers=None):
+    if n % 2 == 0:
+        return 2
+    if is_prime(n):
+        raise ValueError('{} is prime'.format(n))
+
+    workers = workers or os.cpu_count()
+    seeds = (random.getrandbits(64) for _ in count())
+    tasks = chain([(pollard_pm1, n, next(seeds))],
+                  ((pollard_brent, n, seed) for seed in seeds))
+    while True:
+        batch = list(islice(tasks, workers))
+        if workers == 1:
+            results = map(factor_task, batch)
+            factor = next((f for f in results if f), None)
+        else:
+            with Pool(workers) as pool:
+                results = pool.imap_unordered(factor_task, batch)
+                factor = next((f for f in results if f), None)
+        if factor:
+            return factor
+
+
+# split n = p * q
+def break_key(n, workers=None):
 #    sqrt = round(math.sqrt(n))
 #    prime_divisors = (i for i in range(3, sqrt, 2) if is_prime(i) and n % i == 0)
-    p = 2432279
-    assert n % p == 0
+    p = find_factor(n, workers)
     q = n // p
-    return p, q
+    return min(p, q), max(p, q)
 
 
 def rsa_encrypt(message, n, e):
@@ -59,10 +291,61 @@ def rsa_decrypt(message, n, d):
     return [pow(part, d, n) for part in message]
 
 
-def test_rsa(message, p, q):
+def rsa_decrypt_crt(message, key):
+    return [key.power(part) for part in message]
+
+
+# rsa_encrypt()/rsa_decrypt() through a key's SymbolTable: a repeated
+# symbol or ciphertext costs a lookup instead of a modexp
+def rsa_encrypt_cached(message, table):
+    return [table.encrypt(ord(char)) for char in message]
+
+
+def rsa_decrypt_cached(message, table):
+    return [table.decrypt(part) for part in message]
+
+
+# plaintext bytes per block: the largest k with 256**k <= n
+def block_bytes(n):
+    return (n.bit_length() - 1) // 8
+
+
+# ciphertext bytes per block
+def cipher_bytes(n):
+    return (n.bit_length() + 7) // 8
+
+
+# encrypt bytes packing as many of them as fit below n into each block;
+# the last block is filled up with 0x80 0x00 ... padding
+def rsa_encrypt_bytes(data, n, e):
+    k = block_bytes(n)
+    if not k:
+        raise ValueError('n is too small to hold a byte')
+    data = bytes(data) + b'\x80' + bytes(-(len(data) + 1) % k)
+    blocks = (int.from_bytes(data[i:i+k], 'big')
+              for i in range(0, len(data), k))
+    return b''.join(pow(block, e, n).to_bytes(cipher_bytes(n), 'big')
+                    for block in blocks)
+
+
+def rsa_decrypt_bytes(data, n, d):
+    size = cipher_bytes(n)
+    if not data or len(data) % size:
+        raise ValueError('Ciphertext must be whole {}-byte blocks'.format(size))
+    blocks = [int.from_bytes(data[i:i+size], 'big')
+              for i in range(0, len(data), size)]
+    plain = b''.join(block.to_bytes(block_bytes(n), 'big')
+                     for block in rsa_decrypt(blocks, n, d))
+    plain = plain.rstrip(b'\x00')
+    if not plain.endswith(b'\x80'):
+        raise ValueError('Bad padding')
+    return plain[:-1]
+
+
+def test_rsa(message, p=None, q=None, bits=1024, e=None):
     print("Input: p={}, q={}".format(p, q))
     
-    n, e, d = generate_keys(p, q)
+    n, e, d = generate_keys(p, q, bits, e)
     print("Public key: n={}, e={}".format(n, e))
     print("Private key: d={}".format(d))
     
@@ -75,6 +358,110 @@ def test_rsa(message, p, q):
     dec = "".join(chr(ch) for ch in rsa_decrypt(enc, n, d))
     print("Decrypted: \"{}\"".format(dec))
     assert message == dec
+    table = SymbolTable(n, e)
+    assert rsa_encrypt_cached(message, table) == enc
+    # decrypted by inverting the table, without d
+    assert rsa_decrypt_cached(enc, table) == [ord(ch) for ch in message]
+    table = SymbolTable(n, e, d, size=4)
+    assert rsa_decrypt_cached(enc, table) == [ord(ch) for ch in message]
+    assert len(table.symbols) == len(table.ciphertexts) <= 4
+
+
+def test_rsa_bytes(message, bits=1024):
+    n, e, d = generate_keys(bits=bits, e=PUBLIC_EXPONENT)
+    data = message.encode('utf-8')
+    
+    print("===========TEST RSA BYTES===========")
+    enc = rsa_encrypt_bytes(data, n, e)
+    print("Encrypted: {}".format(enc.hex()))
+    print("Blocks: {} (vs {} per character)"
+          .format(len(enc) // cipher_bytes(n), len(message)))
+    dec = rsa_decrypt_bytes(enc, n, d).decode('utf-8')
+    print("Decrypted: \"{}\"".format(dec))
+    assert message == dec
+
+
+# encrypt one item of a batch: a number or a string (char by char)
+def encrypt_item(item, n, e):
+    return pow(item, e, n) if isinstance(item, int) else rsa_encrypt(item, n, e)
+
+
+# decrypt one item of a batch: a number or a list of numbers;
+# d may be a PrivateKey to decrypt via CRT
+def decrypt_item(item, n, d):
+    if isinstance(d, PrivateKey):
+        return d.power(item) if isinstance(item, int) \
+            else rsa_decrypt_crt(item, d)
+    return pow(item, d, n) if isinstance(item, int) else rsa_decrypt(item, n, d)
+
+
+# pool initializer: key material reaches each worker once
+def init_worker(func, n, exponent):
+    global worker_key
+    worker_key = func, n, exponent
+
+
+def run_chunk(chunk):
+    func, n, exponent = worker_key
+    return [func(item, n, exponent) for item in chunk]
+
+
+# apply func to all items on `workers` processes (all cores if None),
+# chunk_size items per task; results keep the order of items
+def run_batch(func, items, n, exponent, workers=None, chunk_size=1024):
+    items = iter(items)
+    chunks = iter(lambda: list(islice(items, chunk_size)), [])
+    if workers == 1:
+        init_worker(func, n, exponent)
+        return list(chain.from_iterable(map(run_chunk, chunks)))
+    with Pool(workers, init_worker, (func, n, exponent)) as pool:
+        return list(chain.from_iterable(pool.imap(run_chunk, chunks)))
+
+
+def rsa_encrypt_batch(messages, n, e, workers=None, chunk_size=1024):
+    return run_batch(encrypt_item, messages, n, e, workers, chunk_size)
+
+
+def rsa_decrypt_batch(messages, n, d, workers=None, chunk_size=1024):
+    return run_batch(decrypt_item, messages, n, d, workers, chunk_size)
+
+
+# check the batch API against a single process and compare their speed
+def test_rsa_batch(count=20000, bits=1024, workers=None):
+    key = generate_private_key(bits=bits, e=PUBLIC_EXPONENT)
+    numbers = [random.randrange(key.n) for _ in range(count)]
+    
+    print("===========TEST RSA BATCH===========")
+    results = []
+    for w in (1, workers or os.cpu_count()):
+        start = time.perf_counter()
+        enc = rsa_encrypt_batch(numbers, key.n, key.e, w)
+        dec = rsa_decrypt_batch(enc, key.n, key, w)
+        elapsed = time.perf_counter() - start
+        print("{} worker(s): {:.0f} ops/s".format(w, 2 * count / elapsed))
+        results.append((enc, dec))
+    
+    assert results[0] == results[1]
+    assert results[0][1] == numbers
+
+
+# check CRT decryption against pow(c, d, n) and compare their speed
+def test_crt(bits=2048, count=50):
+    key = generate_private_key(bits=bits, e=PUBLIC_EXPONENT)
+    enc = [pow(random.randrange(key.n), key.e, key.n) for _ in range(count)]
+    
+    print("===========TEST CRT===========")
+    start = time.perf_counter()
+    dec = rsa_decrypt(enc, key.n, key.d)
+    plain = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    dec_crt = rsa_decrypt_crt(enc, key)
+    crt = time.perf_counter() - start
+    
+    assert dec == dec_crt
+    print("pow(c, d, n): {:.2f} ms".format(plain / count * 1000))
+    print("CRT: {:.2f} ms ({:.1f}x)".format(crt / count * 1000, plain / crt))
 
 
 def break_rsa():
@@ -84,13 +471,14 @@ def break_rsa():
     print("Public key: n={}, e={}".format(n, e))
     
     print("===========HACK RSA===========")
+    start = time.perf_counter()
     p, q = break_key(n)
     print("n divisors: p={}, q={}".format(p, q))
     
-#    phi = (p-1) * (q-1)
-#    d = mod_inverse(e, phi)
-    d = 521419261247795
+    phi = (p-1) * (q-1)
+    d = mod_inverse(e, phi)
     print("Private key: d={}".format(d))
+    print("Broken in {:.1f} ms".format((time.perf_counter() - start) * 1000))
     
     #encrypted message
     message = 403013074606912545180648978557219641194372024501606729868202878976557455422
@@ -120,4 +508,20 @@ if __name__ == "__main__":
     message = "Top secret"
     test_rsa(message, p, q)
     print("------------------------------\n")
+    
+    # test RSA with a generated 2048-bit key and e = 65537
+    test_rsa(message, bits=2048, e=PUBLIC_EXPONENT)
+    print("------------------------------\n")
+    
+    # test bytes RSA encryption & decryption
+    test_rsa_bytes(message * 100)
+    print("------------------------------\n")
+    
+    # test CRT decryption
+    test_crt()
+    print("------------------------------\n")
+    
+    # test batch encryption & decryption on all cores
+    test_rsa_batch(count=2000)
+    print("------------------------------\n")
     
\ No newline at end of file
@@ -1,18 +1,221 @@
 import os
+import sys
+import time
 import json
+import argparse
+import tempfile
 from collections import Counter
-from nltk import bigrams, trigrams
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
 
 
 dir_name = os.path.dirname(__file__)
 rus = 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя'
 rus_freq = 'оеаинтсрвлкмдпуяыьгзбчйхжшюцщэфъё'
+letters = rus[len(rus) // 2:]
+CHUNK = 1 << 22  # chars counted at once
 
 
 def is_rus(t):
     return all(char in rus for char in t)
 
 
+# alphabet index of every cp1251 byte (both cases), -1 for non-letters
+def create_table():
+    table = np.full(256, -1, dtype=np.int32)
+    for i, letter in enumerate(letters):
+        table[letter.encode('cp1251')[0]] = i
+        table[letter.upper().encode('cp1251')[0]] = i
+    return table
+
+
+TABLE = create_table()
+
+
+# alphabet indices of the chars of a text; chars outside cp1251 become '?'
+def to_indices(text):
+    data = text.encode('cp1251', errors='replace')
+    return TABLE[np.frombuffer(data, dtype=np.uint8)]
+
+
+# codes not in seen yet in the order they first appear, marked as seen;
+# windows double in size, so few codes are left to sort in later ones
+def first_seen(codes, seen):
+    new = []
+    start, step = 0, 1024
+    while start < len(codes):
+        window = codes[start:start+step]
+        fresh = window[~seen[window]]
+        if len(fresh):
+            fresh, first = np.unique(fresh, return_index=True)
+            fresh = fresh[np.argsort(first)]
+            seen[fresh] = True
+            new.extend(fresh.tolist())
+        start += step
+        step *= 2
+    return new
+
+
+# letter, bigram and trigram counts of text fed piece by piece, in one
+# pass over the alphabet indices: an n-gram is a base-34 number of
+# indices + 1, so any n-gram with a non-letter (0) is dropped at the end;
+# n-grams are listed in the order they first appear, as a Counter would
+class Ngrams:
+    def __init__(self):
+        size = len(letters) + 1
+        self.counts = [np.zeros(size ** n, dtype=np.int64) for n in (1, 2, 3)]
+        self.seen = [np.zeros(size ** n, dtype=bool) for n in (1, 2, 3)]
+        self.order = [[], [], []]
+        self.tail = np.zeros(2, dtype=np.int32)  # last 2 indices + 1
+
+    # count text as the continuation of the text so far
+    def update(self, text):
+        for i in range(0, len(text), CHUNK):
+            self.count(to_indices(text[i:i+CHUNK]) + 1)
+        return self
+
+    def count(self, x):
+        size = len(letters) + 1
+        x = np.concatenate((self.tail, x))
+        self.tail = x[-2:]
+        a, b, c = x[:-2], x[1:-1], x[2:]
+        bigram = b * size + c
+        ngrams = (c, bigram, a * size * size + bigram)
+        for counts, seen, order, ngram in zip(self.counts, self.seen,
+                                              self.order, ngrams):
+            order.extend(first_seen(ngram, seen))
+            counts += np.bincount(ngram, minlength=len(counts))
+
+    # counts of the n-grams of letters only, n = 1, 2, 3
+    def array(self, n):
+        size = len(letters) + 1
+        counts = self.counts[n - 1].reshape((size,) * n)
+        return counts[(slice(1, None),) * n].ravel()
+
+    # Counter of the n-grams met in the text, letters not met included
+    # with 0 for n = 1
+    def counter(self, n):
+        size = len(letters) + 1
+        counter = Counter()
+        for code in self.order[n - 1]:
+            digits = [code // size ** i % size for i in range(n - 1, -1, -1)]
+            if all(digits):
+                counter[''.join(letters[d - 1] for d in digits)] = \
+                    int(self.counts[n - 1][code])
+        if n == 1:
+            for letter in letters:
+                counter.setdefault(letter, 0)
+        return counter
+
+    # add the counts of another text (no n-grams across the two)
+    def merge(self, other):
+        for counts, seen, order, other_counts, other_order in zip(
+                self.counts, self.seen, self.order, other.counts, other.order):
+            counts += other_counts
+            new = [code for code in other_order if not seen[code]]
+            seen[new] = True
+            order.extend(new)
+        return self
+
+    # save the counts with the list of files they come from
+    def save(self, file_name, files=()):
+        arrays = {'files': np.array(files, dtype=str)}
+        for n in (1, 2, 3):
+            arrays['counts{}'.format(n)] = self.counts[n - 1]
+            arrays['order{}'.format(n)] = np.array(self.order[n - 1],
+                                                   dtype=np.int64)
+        with open(file_name, 'wb') as file:
+            np.savez(file, **arrays)
+
+    # counts and files saved with save()
+    @classmethod
+    def load(cls, file_name):
+        ngrams = cls()
+        with np.load(file_name) as arrays:
+            for n in (1, 2, 3):
+                ngrams.counts[n - 1] = arrays['counts{}'.format(n)]
+                ngrams.order[n - 1] = arrays['order{}'.format(n)].tolist()
+                ngrams.seen[n - 1][ngrams.order[n - 1]] = True
+            files = arrays['files'].tolist()
+        return ngrams, files
+
+
+""" corpus """
+# n-grams of a file read chunk chars at a time; Ngrams carries the last
+# 2 chars of a chunk over, so no n-gram is lost at chunk boundaries
+def count_file(file_path, chunk=CHUNK):
+    ngrams = Ngrams()
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+        for text in iter(lambda: file.read(chunk), ''):
+            ngrams.update(text)
+    return ngrams
+
+
+# files given and files in the directories given, as absolute paths
+def corpus_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return [os.path.abspath(f) for f in files]
+
+
+# n-grams of all the files, counted on `workers` processes and merged in
+# the order of the files; with totals_file, files already counted there
+# are skipped and the new totals are saved back
+def count_corpus(paths, totals_file=None, workers=None, chunk=CHUNK):
+    ngrams, counted = Ngrams(), []
+    if totals_file and os.path.exists(totals_file):
+        ngrams, counted = Ngrams.load(totals_file)
+    done = set(counted)
+    files = [f for f in corpus_files(paths) if f not in done]
+    
+    task = partial(count_file, chunk=chunk)
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(files) < 2:
+        for part in map(task, files):
+            ngrams.merge(part)
+    else:
+        with Pool(workers) as pool:
+            for part in pool.imap(task, files):
+                ngrams.merge(part)
+    
+    if totals_file:
+        ngrams.save(totals_file, counted + files)
+    return ngrams
+
+
+def corpus_command(argv):
+    parser = argparse.ArgumentParser(
+        description='Count letters, bigrams and trigrams of text files')
+    parser.add_argument('paths', nargs='+', help='files or directories')
+    parser.add_argument('-t', '--totals',
+                        help='saved totals to add the new files to')
+    parser.add_argument('-o', '--output', default='output',
+                        help='directory for the json tables')
+    parser.add_argument('-w', '--workers', type=int)
+    parser.add_argument('-s', '--solve', metavar='FILE',
+                        help='ciphertext to decipher, the corpus being '
+                             'plain text to score keys with')
+    args = parser.parse_args(argv)
+    
+    ngrams = count_corpus(args.paths, args.totals, args.workers)
+    if args.solve:
+        with open(args.solve, 'r', encoding='utf-8') as file:
+            text = file.read()
+        print(Substitution(solve(text, ngrams, workers=args.workers))(text))
+        return
+    for n, name in zip((1, 2, 3), ('letters', 'bigrams', 'trigrams')):
+        write_json(os.path.join(args.output, name + '_freq.json'),
+                   ngrams.counter(n))
+
+
 def read_file(file_name):
     file_path =  dir_name + '/' + file_name
     with open(file_path, 'r') as file:
@@ -36,9 +239,13 @@ def sort_by_frequency(counter):
                 sorted(counter.items(), key=lambda item: -item[1]))
         
         
+# substitution matching letters by frequency
+def frequency_dict(letters_freq):
+    return dict(zip(sort_by_frequency(letters_freq).keys(), rus_freq))
+
+
 def preprocess(text, letters_freq):
-    freq_dict = dict(zip(sort_by_frequency(letters_freq).keys(), rus_freq))
-    return replace(text, freq_dict)
+    return Substitution(frequency_dict(letters_freq))(text)
         
         
 def replace(text, freq_dict):
@@ -52,21 +259,192 @@ def replace(text, freq_dict):
         yield new_char
 
 
+# replace() compiled into a str.translate table: every char replace()
+# changes (a key, its upper and title case) mapped to what it yields
+class Substitution:
+    def __init__(self, freq_dict):
+        table = {}
+        for key in freq_dict:
+            for char in {key, key.upper(), key.title()}:
+                if len(char) == 1 and char.lower() in freq_dict:
+                    table[char] = ''.join(replace(char, freq_dict))
+        self.table = str.maketrans(table)
+
+    def __call__(self, text):
+        return text.translate(self.table)
+
+    # translate text coming in chunks
+    def stream(self, chunks):
+        for chunk in chunks:
+            yield chunk.translate(self.table)
+
+
+""" solver """
+worker_solver = None
+
+
+# log probabilities of the n-grams of a reference text, the ones not met
+# there counted `floor` times
+def log_probs(reference, n, floor=0.1):
+    counts = reference.array(n) + floor
+    return np.log(counts / counts.sum())
+
+
+# hill climbing over swaps in a substitution key, key[i] being the plain
+# letter index of cipher letter i; a key scores the log probabilities of
+# the ciphertext bigrams and trigrams it gives, each distinct n-gram
+# weighted by its count
+class Solver:
+    def __init__(self, ngrams, reference):
+        size = len(letters)
+        self.tables = []
+        for n in (2, 3):
+            counts = ngrams.array(n)
+            codes = np.flatnonzero(counts)
+            digits = np.stack([codes // size ** i % size
+                               for i in range(n - 1, -1, -1)], axis=1)
+            # index[i]: rows of the n-grams with cipher letter i in them
+            index = [np.flatnonzero((digits == i).any(axis=1))
+                     for i in range(size)]
+            powers = size ** np.arange(n - 1, -1, -1)
+            self.tables.append((digits, counts[codes], log_probs(reference, n),
+                                index, powers))
+
+    def score(self, key):
+        return sum(float(counts @ log_p[key[digits] @ powers])
+                   for digits, counts, log_p, _, powers in self.tables)
+
+    # score change from swapping key[i] and key[j]: only the n-grams with
+    # cipher letter i or j in them are rescored
+    def delta(self, key, i, j):
+        swapped = key.copy()
+        swapped[i], swapped[j] = key[j], key[i]
+        delta = 0.0
+        for digits, counts, log_p, index, powers in self.tables:
+            rows = np.union1d(index[i], index[j])
+            plain = key[digits[rows]] @ powers
+            new = swapped[digits[rows]] @ powers
+            delta += float(counts[rows] @ (log_p[new] - log_p[plain]))
+        return delta
+
+    # take every swap that improves the score, in random order, until none
+    # does; restarts other than 0 begin with the key shuffled by random swaps
+    def climb(self, key, restart=0):
+        rng = np.random.default_rng(restart)
+        key = key.copy()
+        size = len(key)
+        if restart:
+            for i, j in rng.integers(size, size=(size // 2, 2)):
+                key[i], key[j] = key[j], key[i]
+        pairs = [(i, j) for i in range(size) for j in range(i + 1, size)]
+        improved = True
+        while improved:
+            improved = False
+            for k in rng.permutation(len(pairs)):
+                i, j = pairs[k]
+                if self.delta(key, i, j) > 0:
+                    key[i], key[j] = key[j], key[i]
+                    improved = True
+        return self.score(key), key
+
+
+def init_worker(solver):
+    global worker_solver
+    worker_solver = solver
+
+
+def climb_task(args):
+    return worker_solver.climb(*args)
+
+
+# substitution for a ciphertext found by climbing from the preprocess()
+# mapping, restarts climbs run on `workers` processes; reference is the
+# Ngrams of plain text in the language (count_corpus() of a corpus)
+def solve(text, reference, restarts=8, workers=None):
+    ngrams = Ngrams().update(text)
+    freq_dict = frequency_dict(ngrams.counter(1))
+    key = np.array([letters.index(freq_dict[letter]) for letter in letters])
+    solver = Solver(ngrams, reference)
+    
+    tasks = [(key, restart) for restart in range(restarts)]
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        init_worker(solver)
+        results = list(map(climb_task, tasks))
+    else:
+        with Pool(workers, initializer=init_worker,
+                  initargs=(solver,)) as pool:
+            results = pool.map(climb_task, tasks)
+    score, key = max(results, key=lambda result: result[0])
+    return {letter: letters[k] for letter, k in zip(letters, key)}
+
+
+# check Ngrams (fed in pieces) against counting n-gram tuples
+def test_ngrams(text, piece=1000):
+    ngrams = Ngrams()
+    for i in range(0, len(text), piece):
+        ngrams.update(text[i:i+piece])
+    
+    lower = text.lower()
+    for n in (1, 2, 3):
+        tuples = zip(*(lower[i:] for i in range(n)))
+        counter = Counter(''.join(t) for t in tuples if is_rus(t))
+        if n == 1:
+            for letter in letters:
+                counter.setdefault(letter, 0)
+        assert list(ngrams.counter(n).items()) == list(counter.items())
+
+
+# check count_corpus() (in one go and file by file with saved totals)
+# against counting each file in one piece
+def test_corpus(text, files=5):
+    size = -(-len(text) // files)
+    with tempfile.TemporaryDirectory() as dir_path:
+        paths = []
+        for i in range(files):
+            paths.append(os.path.join(dir_path, 'part{}'.format(i)))
+            write_file(paths[-1], text[i*size:(i+1)*size])
+        expected = Ngrams()
+        for i in range(files):
+            expected.merge(Ngrams().update(text[i*size:(i+1)*size]))
+        
+        totals = os.path.join(dir_path, 'totals.npz')
+        for i in range(files):
+            count_corpus(paths[:i+1], totals, workers=1, chunk=100)
+        for ngrams in (count_corpus(paths, workers=2, chunk=77),
+                       Ngrams.load(totals)[0]):
+            for n in (1, 2, 3):
+                assert list(ngrams.counter(n).items()) == \
+                    list(expected.counter(n).items())
+
+
+# check Substitution (in one piece and in chunks) against replace()
+def test_substitution(text, freq_dict, piece=1000):
+    substitution = Substitution(freq_dict)
+    expected = ''.join(replace(text, freq_dict))
+    assert substitution(text) == expected
+    chunks = (text[i:i+piece] for i in range(0, len(text), piece))
+    assert ''.join(substitution.stream(chunks)) == expected
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        corpus_command(sys.argv[1:])
+        sys.exit()
+    
     # 1. Read the text from a file
     text = read_file('5_input')
     print('===== SOURCE ====')
     print(text)
    
     # 2. Calculate occurences of letters, bigrams and trigrams
-    letters_freq = Counter(char for char in text.lower() if is_rus(char))
-    bigrams_freq = Counter(t for t in bigrams(text.lower()) if is_rus(t))
-    trigrams_freq = Counter(t for t in trigrams(text.lower()) if is_rus(t))
-    
-    # include all of the alphabet in letters_freq
-    for letter in rus.lower():
-        if letter not in letters_freq:
-            letters_freq[letter] = 0
+    # (all of the alphabet included in letters_freq)
+    test_ngrams(text)
+    test_corpus(text)
+    ngrams = Ngrams().update(text)
+    letters_freq = ngrams.counter(1)
+    bigrams_freq = ngrams.counter(2)
+    trigrams_freq = ngrams.counter(3)
     
     # 3. Write the collected statistics to a file
     write_json('output/letters_freq.json', letters_freq)
@@ -74,7 +452,7 @@ if __name__ == "__main__":
     write_json('output/trigrams_freq.json', trigrams_freq)
     
     # 4. Preprocess the text by matching letter frequences
-    preprocessed = ''.join(preprocess(text, letters_freq))
+    preprocessed = preprocess(text, letters_freq)
     write_file('output/preprocessed', preprocessed)
     
 #    txt_freq = 'тэлрдкювъжьнзибшоефгщпаыухчясйцмё'
@@ -146,8 +524,16 @@ if __name__ == "__main__":
                  'ё': 'ё'} # ok
     
     # 5. Output deciphered text 
-    deciphered = ''.join(replace(text, freq_dict))
+    test_substitution(text + text.upper(), freq_dict)
+    deciphered = Substitution(freq_dict)(text)
     print('===== DECIPHERED ====')
     print(deciphered)
     write_file('output/deciphered', deciphered)
+    
+    # 6. Decipher automatically against 5_reference, Russian text that
+    # shares no passages with the input
+    start = time.perf_counter()
+    solved = solve(text, Ngrams().update(read_file('5_reference')))
+    print('solved in {:.2f} s'.format(time.perf_counter() - start))
+    assert Substitution(solved)(text) == deciphered
     
\ No newline at end of file